@@ -1,16 +1,26 @@
+import io
 import os
+import re
+import time
+import asyncio
 import logging
 import datetime
-from datetime import timedelta, timezone
+import heapq
+from functools import lru_cache
 from pathlib import Path
-
-import psycopg2.errors
-from timezonefinder import TimezoneFinder
+from types import MappingProxyType
+
+import asyncpg
+try:
+    # быстрый event loop; на Windows его нет — остаёмся на стандартном
+    import uvloop
+except ImportError:
+    uvloop = None
 from dotenv import load_dotenv
-from psycopg2.pool import ThreadedConnectionPool
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.schedulers.base import STATE_STOPPED
+from timezonefinder import TimezoneFinder, TimezoneFinderL
 
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.triggers.cron import CronTrigger
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
     ReplyKeyboardMarkup, KeyboardButton
@@ -18,43 +28,68 @@ from telegram import (
 from telegram.ext import (
     ApplicationBuilder, ContextTypes,
     CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, filters
+    ConversationHandler, TypeHandler, ApplicationHandlerStop, filters
 )
+from telegram.error import RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 # Полный список дней недели на русском
-WEEK = [
+WEEK = (
     "понедельник","вторник","среда","четверг",
     "пятница","суббота","воскресенье"
-]
+)
 
-# Маппинги для cron и цифр
-RU_TO_CRON_DAY = {
-    "понедельник":"mon","вторник":"tue","среда":"wed",
-    "четверг":"thu","пятница":"fri","суббота":"sat",
-    "воскресенье":"sun"
-}
-NUM_TO_RU_DAY = {
-    "1":"понедельник","2":"вторник","3":"среда","4":"четверг",
-    "5":"пятница","6":"суббота","7":"воскресенье","0":"воскресенье"
-}
+# Дни как индексы 0..6 (пн..вс): название/цифра разбирается один раз,
+# дальше только индексация кортежей
+CRON_DAYS = ("mon","tue","wed","thu","fri","sat","sun")
+# таблицы только для чтения — случайная запись в них упадёт сразу
+DAY_LOOKUP = MappingProxyType({
+    **{ru: i for i, ru in enumerate(WEEK)},
+    **{str(i + 1): i for i in range(7)},
+    "0": 6,  # 0 — тоже воскресенье
+})
+
+def parse_days(dr: str) -> list[int]|None:
+    if "-" in dr and "," not in dr:
+        i0, i1 = (DAY_LOOKUP.get(x.strip()) for x in dr.split("-", 1))
+        if i0 is None or i1 is None:
+            return None
+        if i0 <= i1:
+            return list(range(i0, i1+1))
+        return list(range(i0, 7)) + list(range(0, i1+1))
+    days = [DAY_LOOKUP.get(tok.strip()) for tok in dr.split(",")]
+    return None if None in days else days
 
-HAS_THREAD_COL = False
-ADD_INPUT, DELETE_INPUT = range(2)
+# В БД дни хранятся битовой маской: бит i — день WEEK[i]
+def days_mask(days: list[int]) -> int:
+    mask = 0
+    for i in days:
+        mask |= 1 << i
+    return mask
 
-def get_thread_id(update: Update) -> int|None:
-    return getattr(update.effective_message, "message_thread_id", None)
+@lru_cache(maxsize=128)
+def mask_to_cron(mask: int) -> str:
+    return ",".join(CRON_DAYS[i] for i in range(7) if mask >> i & 1)
 
-def with_thread(kwargs: dict, update: Update) -> dict:
-    tid = get_thread_id(update)
-    if tid is not None:
-        kwargs["message_thread_id"] = tid
-    return kwargs
+@lru_cache(maxsize=128)
+def mask_to_ru(mask: int) -> str:
+    return ",".join(WEEK[i] for i in range(7) if mask >> i & 1)
 
-def get_main_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [["Добавить","Список"],["Удалить","Помощь"]],
-        resize_keyboard=True, one_time_keyboard=False
-    )
+# Нормализация разделителей дней за один проход вместо цепочки replace()
+DAY_SEP_TABLE = str.maketrans({";": ",", "/": ",", "–": "-", "—": "-"})
+
+# ЧЧ:ММ, часы и минуты могут быть однозначными (9:05, 9:5);
+# проверяем через fullmatch — "$" пропустил бы хвостовой перевод строки
+TIME_RE = re.compile(r"([01]?\d|2[0-3]):([0-5]?\d)")
+
+HAS_THREAD_COL = False
+ADD_INPUT, DELETE_INPUT = range(2)
+
+# Клавиатура неизменна (объекты PTB заморожены) — строим один раз
+MAIN_KB = ReplyKeyboardMarkup(
+    [["Добавить","Список"],["Удалить","Помощь"]],
+    resize_keyboard=True, one_time_keyboard=False
+)
 
 INLINE_KB = InlineKeyboardMarkup([
     [InlineKeyboardButton("Добавить", callback_data="add")],
@@ -73,58 +108,298 @@ DB_PORT     = os.getenv("DB_PORT","5432")
 DB_NAME     = os.getenv("DB_NAME")
 DB_USER     = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
-ADMIN_IDS   = {int(x) for x in os.getenv("ADMIN_IDS","").split(",") if x.isdigit()}
+# Webhook: если WEBHOOK_URL задан, Telegram сам присылает апдейты,
+# иначе — long polling
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL","").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN","0.0.0.0")
+WEBHOOK_PORT   = int(os.getenv("WEBHOOK_PORT","8443"))
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH") or BOT_TOKEN
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+ADMIN_IDS   = frozenset(
+    int(x) for x in os.getenv("ADMIN_IDS","").split(",") if x.strip().isdigit()
+)
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-# Пул соединений
-db_pool = ThreadedConnectionPool(
-    1, 10,
-    host=DB_HOST, port=DB_PORT,
-    dbname=DB_NAME, user=DB_USER,
-    password=DB_PASSWORD
+# Горячие запросы: asyncpg сам готовит их и кэширует на каждом соединении
+SQL = {
+    "select_reminders_user_chat":
+        "SELECT days, time, text FROM reminders "
+        "WHERE user_id=$1 AND chat_id=$2 ORDER BY id",
+    # вставка сразу возвращает и номер в списке: CTE не видит свою же
+    # строку, поэтому позиция = уже существующие + 1
+    "insert_reminder_thr":
+        "WITH ins AS ("
+        " INSERT INTO reminders"
+        "(user_id,chat_id,message_thread_id,days,time,text) "
+        " VALUES($1,$2,$3,$4,$5,$6) RETURNING id) "
+        "SELECT ins.id, (SELECT count(*) FROM reminders "
+        "WHERE user_id=$1 AND chat_id=$2) + 1 FROM ins",
+    "insert_reminder":
+        "WITH ins AS ("
+        " INSERT INTO reminders(user_id,chat_id,days,time,text) "
+        " VALUES($1,$2,$3,$4,$5) RETURNING id) "
+        "SELECT ins.id, (SELECT count(*) FROM reminders "
+        "WHERE user_id=$1 AND chat_id=$2) + 1 FROM ins",
+    # поиск по номеру в списке и удаление — один атомарный запрос
+    "delete_reminder_at":
+        "DELETE FROM reminders WHERE id=("
+        " SELECT id FROM reminders WHERE user_id=$1 AND chat_id=$2"
+        " ORDER BY id OFFSET $3 LIMIT 1"
+        ") RETURNING id",
+    "upsert_tz":
+        "INSERT INTO user_timezones(user_id,timezone) VALUES($1,$2) "
+        "ON CONFLICT(user_id) DO UPDATE SET timezone=EXCLUDED.timezone",
+}
+
+# Пул asyncpg: запросы не блокируют event loop, простаивающие соединения
+# закрываются сами, а зависшие запросы и транзакции обрубает сервер
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+DB_PARAMS = dict(
+    host=DB_HOST, port=int(DB_PORT),
+    database=DB_NAME, user=DB_USER,
+    password=DB_PASSWORD,
+    timeout=3,
 )
-def get_conn(): return db_pool.getconn()
-def put_conn(conn): db_pool.putconn(conn)
+DB_SERVER_SETTINGS = {
+    "statement_timeout": "5000",
+    "idle_in_transaction_session_timeout": "10000",
+}
+# За PgBouncer (pool_mode=transaction) серверные prepared statements не
+# переживают транзакцию, а startup-параметры он не пропускает: кэш asyncpg
+# выключаем, таймауты задаются на роли (ALTER ROLE ... SET). LISTEN через
+# такой пул не работает — слушатель ходит в Postgres напрямую
+# (DB_LISTEN_HOST/DB_LISTEN_PORT, если PgBouncer стоит на другом хосте/порту).
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER") == "1"
+DB_LISTEN_HOST = os.getenv("DB_LISTEN_HOST", DB_HOST)
+DB_LISTEN_PORT = int(os.getenv("DB_LISTEN_PORT", DB_PORT))
+db_pool: asyncpg.Pool|None = None
+
+async def create_db_pool():
+    global db_pool
+    # пул создаётся внутри работающего loop'а — в on_startup
+    db_pool = await asyncpg.create_pool(
+        **DB_PARAMS,
+        min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+        max_inactive_connection_lifetime=600,
+        command_timeout=10,
+        statement_cache_size=0 if DB_PGBOUNCER else 100,
+        server_settings=None if DB_PGBOUNCER else DB_SERVER_SETTINGS
+    )
+    logger.info(
+        "Пул БД: открыто %d соединений (min %d, max %d)",
+        db_pool.get_size(), db_pool.get_min_size(), db_pool.get_max_size()
+    )
 
-scheduler = AsyncIOScheduler()
+# Напоминания живут в APScheduler'е JobQueue самого PTB — отдельный планировщик
+# не нужен. По cron-job на напоминание: MemoryJobStore держит их отсортированными
+# по next_run_time, так что на тике трогаются только наступившие. Опоздавший
+# (из-за нагрузки на loop) запуск не теряем и не дублируем. Повторная загрузка
+# с тем же id заменяет задачу, а не добавляет вторую.
+REMINDER_JOB_OPTS = {
+    "coalesce": True,
+    "misfire_grace_time": 60,
+    "replace_existing": True,
+}
 DELETE_DELAY_MINUTES = 59
 
-async def delete_msg(chat_id: int, message_id: int):
+# Триггер без состояния — одинаковые расписания делят один объект
+@lru_cache(maxsize=1024)
+def cron_trigger(cron_days: str, hh: int, mm: int, tz: str) -> CronTrigger:
+    return CronTrigger(day_of_week=cron_days, hour=hh, minute=mm, timezone=tz)
+
+# deleteMessages принимает до 100 id одного чата за вызов
+DELETE_BATCH = 100
+# удаления всех чатов приходят в одну секунду (напоминания — ровно в минуту),
+# поэтому одновременных запросов к API не больше DELETE_CONCURRENCY
+DELETE_CONCURRENCY = 25
+delete_sem = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+async def delete_msgs(chat_id: int, message_ids: list[int]) -> bool:
     try:
-        await application.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception as e:
-        logger.warning("Не удалось удалить %s:%s — %s", chat_id, message_id, e)
+        async with delete_sem:
+            await application.bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        return True
+    except RetryAfter as e:
+        # флуд-контроль: возвращаем в очередь на после паузы, а не теряем
+        logger.warning("Flood control, удаление %s отложено на %s с", chat_id, e.retry_after)
+        deadline = time.monotonic() + e.retry_after
+        for message_id in message_ids:
+            heapq.heappush(del_queue, (deadline, chat_id, message_id))
+        return False
+    except TelegramError as e:
+        logger.warning("Не удалось удалить %s:%s — %s", chat_id, message_ids, e)
+        return False
+
+def by_chat_batches(pairs: list[tuple[int, int]]) -> list[tuple[int, list[int]]]:
+    chats: dict[int, list[int]] = {}
+    for chat_id, message_id in pairs:
+        chats.setdefault(chat_id, []).append(message_id)
+    return [
+        (chat_id, mids[i:i + DELETE_BATCH])
+        for chat_id, mids in chats.items()
+        for i in range(0, len(mids), DELETE_BATCH)
+    ]
+
+# Очередь на удаление: куча (срок по monotonic, chat_id, message_id) —
+# задержка у schedule_deletion настраиваемая, так что порядок добавления
+# не совпадает со сроком.
+del_queue: list[tuple[float, int, int]] = []
+SWEEP_INTERVAL = 1
+# порождённые свипером удаления — дожидаемся их при остановке
+delete_tasks: set[asyncio.Task] = set()
 
 def schedule_deletion(chat_id: int, message_id: int,
                       delay_minutes: int = DELETE_DELAY_MINUTES):
-    run_date = datetime.datetime.now(timezone.utc) + timedelta(minutes=delay_minutes)
-    scheduler.add_job(delete_msg, trigger="date", run_date=run_date,
-                      args=[chat_id, message_id])
+    heapq.heappush(del_queue, (time.monotonic() + delay_minutes * 60, chat_id, message_id))
+
+async def delete_expired(batch: list[tuple[int, int]]):
+    # один запрос к API на чат (по 100 сообщений), а не на каждое сообщение
+    chunks = by_chat_batches(batch)
+    ok = await asyncio.gather(*(delete_msgs(c, mids) for c, mids in chunks))
+    # удалённые из чата строки убираем из bot_messages одним запросом за тик
+    done = [(c, m) for (c, mids), d in zip(chunks, ok) if d for m in mids]
+    if not done:
+        return
+    try:
+        await db_delete_bot_messages(done)
+    except Exception as e:
+        logger.error("Не удалось почистить bot_messages (%s шт.): %s", len(done), e)
+
+async def deletion_sweeper():
+    # один таймер вместо отдельной задачи APScheduler на каждое сообщение
+    while True:
+        now = time.monotonic()
+        batch = []
+        while del_queue and del_queue[0][0] <= now:
+            _, chat_id, message_id = heapq.heappop(del_queue)
+            batch.append((chat_id, message_id))
+        if batch:
+            task = asyncio.create_task(delete_expired(batch))
+            delete_tasks.add(task)
+            task.add_done_callback(delete_tasks.discard)
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+# Быстрый поиск по сетке, только если вся ячейка в одной зоне; у границ
+# (unique_timezone_at вернул None) — полный полигональный TimezoneFinder.
+# Модуль импортируем сразу — отсутствие пакета видно при старте, а данные
+# обоих finder'ов грузятся при первой геолокации, уже в потоке
+tf = None
+tf_full = None
+
+# координаты округляем до 0.01° (~1 км) — соседние точки попадают в кэш
+@lru_cache(maxsize=4096)
+def tz_lookup(lat_q: int, lng_q: int) -> str:
+    global tf, tf_full
+    lat, lng = lat_q / 100, lng_q / 100
+    if tf is None:
+        tf = TimezoneFinderL(in_memory=True)
+    tz = tf.unique_timezone_at(lng=lng, lat=lat)
+    if tz is None:
+        if tf_full is None:
+            tf_full = TimezoneFinder(in_memory=True)
+        tz = tf_full.timezone_at(lat=lat, lng=lng)
+    return tz or "UTC"
+
+def timezone_at(lat: float, lng: float) -> str:
+    return tz_lookup(round(lat * 100), round(lng * 100))
+
+# Кэши горячих проверок. allowed_users, autodel_users и tz_cache меняет
+# только этот процесс: при нескольких экземплярах бота они у соседей
+# устаревают до перезапуска. Между экземплярами через LISTEN/NOTIFY
+# синхронизируется лишь глобальный флаг автоудаления (autodel_global).
+allowed_users: set[int] = set()
+# пользователи с автоудалением — сразу фильтр PTB: чужие апдейты
+# до обработчика даже не доходят
+autodel_users = filters.User(allow_empty=False)
+tz_cache: dict[int, str] = {}
+autodel_global = False
+AUTODEL_CHANNEL = "autodel_changed"
+autodel_listening = asyncio.Event()
+
+# Отправленные сообщения копим в памяти и пишем в bot_messages пачками
+pending_msgs: list[tuple[int, int]] = []
+FLUSH_INTERVAL = 1
+
+async def db_insert_bot_messages(batch: list[tuple[int, int]]):
+    chat_ids, msg_ids = zip(*batch)
+    # вся пачка — один запрос с двумя массивами
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO bot_messages(chat_id,message_id) "
+            "SELECT * FROM unnest($1::bigint[], $2::bigint[]) "
+            "ON CONFLICT DO NOTHING",
+            chat_ids, msg_ids
+        )
 
-tf = TimezoneFinder()
+async def db_delete_bot_messages(batch: list[tuple[int, int]]):
+    chat_ids, msg_ids = zip(*batch)
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "DELETE FROM bot_messages b "
+            "USING unnest($1::bigint[], $2::bigint[]) AS d(chat_id, message_id) "
+            "WHERE b.chat_id=d.chat_id AND b.message_id=d.message_id",
+            chat_ids, msg_ids
+        )
 
 def record_bot_message(chat_id: int, message_id: int):
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO bot_messages(chat_id,message_id) VALUES(%s,%s)",
-            (chat_id, message_id)
-        )
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
+    pending_msgs.append((chat_id, message_id))
+
+async def send_temp(chat_id: int, text: str, thread_id: int|None = None, **kw):
+    # отправка + запись в bot_messages + постановка в очередь на удаление
+    msg = await application.bot.send_message(
+        chat_id=chat_id, text=text, message_thread_id=thread_id, **kw
+    )
+    record_bot_message(msg.chat_id, msg.message_id)
+    schedule_deletion(msg.chat_id, msg.message_id)
+    return msg
+
+async def cleanup_trigger(update: Update):
+    # убираем «след» команды: отвечаем на callback или удаляем сообщение
+    if update.callback_query:
+        await update.callback_query.answer()
+    elif update.message:
+        try:
+            await application.bot.delete_message(
+                update.message.chat_id, update.message.message_id
+            )
+        except TelegramError:
+            pass
+
+# снятие пачки и INSERT под одним замком: /clearchat дождётся записи,
+# которую флашер уже начал, а не увидит пустой буфер
+flush_lock = asyncio.Lock()
+
+async def flush_bot_messages():
+    async with flush_lock:
+        if not pending_msgs:
+            return
+        batch = pending_msgs[:]
+        pending_msgs.clear()
+        try:
+            # shield: отмена флашера при остановке не теряет уже снятую пачку
+            await asyncio.shield(db_insert_bot_messages(batch))
+        except Exception as e:
+            logger.error("Не удалось записать bot_messages (%s шт.): %s", len(batch), e)
+
+async def bot_messages_flusher():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_bot_messages()
+
+# pg_attribute — одна таблица каталога, information_schema — тяжёлое представление
+REMINDERS_COL_Q = (
+    "SELECT 1 FROM pg_attribute WHERE attrelid='reminders'::regclass "
+    "AND attname=$1 AND NOT attisdropped"
+)
 
-def init_db():
+async def init_db():
     global HAS_THREAD_COL
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
+    async with db_pool.acquire() as conn:
         # создаём каждую таблицу своим execute
         ddls = [
             """
@@ -140,7 +415,7 @@ def init_db():
                                     ON DELETE CASCADE,
                 chat_id           BIGINT NOT NULL,
                 message_thread_id BIGINT,
-                day_of_week       TEXT    NOT NULL,
+                days              SMALLINT NOT NULL CHECK (days BETWEEN 1 AND 127),
                 time              TIME    NOT NULL,
                 text              TEXT    NOT NULL
             );
@@ -170,366 +445,404 @@ def init_db():
             """
         ]
         for ddl in ddls:
-            cur.execute(ddl)
-            conn.commit()
+            await conn.execute(ddl)
+
+        # Индексы может менять только владелец таблиц (права проверяются
+        # раньше IF [NOT] EXISTS) — без прав работаем с тем, что есть
+        # id в хвосте индекса — ORDER BY id в списке идёт без сортировки
+        try:
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_reminders_user_chat_id "
+                "ON reminders(user_id, chat_id, id)"
+            )
+        except asyncpg.InsufficientPrivilegeError:
+            logger.warning("Нет прав на индекс reminders — пропускаем")
+
+        # уникальный индекс заодно обслуживает выборки по chat_id
+        try:
+            await conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ux_bot_messages_chat_msg "
+                "ON bot_messages(chat_id, message_id)"
+            )
+        except asyncpg.InsufficientPrivilegeError:
+            logger.warning("Нет прав на индекс bot_messages — пропускаем")
+        except asyncpg.UniqueViolationError:
+            logger.warning("В bot_messages есть дубли — создаём неуникальный индекс")
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_bot_messages_chat "
+                "ON bot_messages(chat_id)"
+            )
 
         # Заполняем начальные значения
         if ADMIN_IDS:
-            cur.executemany(
-                "INSERT INTO allowed_users(user_id) VALUES(%s) ON CONFLICT DO NOTHING",
+            await conn.executemany(
+                "INSERT INTO allowed_users(user_id) VALUES($1) ON CONFLICT DO NOTHING",
                 [(aid,) for aid in ADMIN_IDS]
             )
-            conn.commit()
 
-        cur.execute(
+        await conn.execute(
             "INSERT INTO config(key,value) VALUES('auto_delete_enabled','false') "
             "ON CONFLICT(key) DO NOTHING"
         )
-        conn.commit()
 
         # Пытаемся добавить/мигрировать колонку message_thread_id
         try:
-            cur.execute(
+            await conn.execute(
                 "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS message_thread_id BIGINT"
             )
-            conn.commit()
-        except psycopg2.errors.InsufficientPrivilege:
-            conn.rollback()
+            HAS_THREAD_COL = True
+        except asyncpg.InsufficientPrivilegeError:
             logger.warning("Нет прав на добавление message_thread_id — пропускаем")
+            # колонка могла остаться от прежнего владельца
+            HAS_THREAD_COL = await conn.fetchval(
+                REMINDERS_COL_Q, "message_thread_id"
+            ) is not None
 
-        try:
-            cur.execute(
-                "ALTER TABLE reminders ALTER COLUMN day_of_week TYPE TEXT "
-                "USING day_of_week::text"
-            )
-            conn.commit()
-        except psycopg2.errors.InsufficientPrivilege:
-            conn.rollback()
-            logger.warning(
-                "Нет прав на миграцию day_of_week — выполните вручную:\n"
-                "ALTER TABLE reminders ALTER COLUMN day_of_week TYPE TEXT USING day_of_week::text;"
-            )
-        except Exception as e:
-            conn.rollback()
-            logger.error("Ошибка миграции day_of_week: %s", e)
-
-        # Проверяем, появилась ли колонка
-        cur.execute("""
-            SELECT 1
-            FROM information_schema.columns
-           WHERE table_name='reminders'
-             AND column_name='message_thread_id'
-        """)
-        HAS_THREAD_COL = cur.fetchone() is not None
-        cur.close()
-    finally:
-        put_conn(conn)
-
-
-async def is_allowed(user_id: int) -> bool:
-    if user_id in ADMIN_IDS:
-        return True
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM allowed_users WHERE user_id=%s", (user_id,))
-        ok = cur.fetchone() is not None
-        cur.close()
-        return ok
-    finally:
-        put_conn(conn)
-
-def global_autodel_enabled() -> bool:
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM config WHERE key='auto_delete_enabled'")
-        row = cur.fetchone()
-        cur.close()
-        return bool(row and row[0]=='true')
-    finally:
-        put_conn(conn)
-
-async def send_reminder(chat_id: int, thread_id: int|None, text: str):
-    kwargs = {"chat_id":chat_id,"text":text}
-    if thread_id is not None:
-        kwargs["message_thread_id"] = thread_id
-    msg = await application.bot.send_message(**kwargs)
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+        # day_of_week (строка названий) -> days (битовая маска), одной транзакцией
+        if await conn.fetchval(REMINDERS_COL_Q, "day_of_week"):
+            try:
+                async with conn.transaction():
+                    # ADD COLUMN держит эксклюзивную блокировку до конца
+                    # транзакции — новые строки между чтением и DROP не появятся
+                    await conn.execute(
+                        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS days SMALLINT "
+                        "CHECK (days BETWEEN 1 AND 127)"
+                    )
+                    rows = await conn.fetch("SELECT id, day_of_week::text FROM reminders")
+                    masks, bad = [], []
+                    for rid, d in rows:
+                        days = parse_days(d)
+                        if days:
+                            masks.append((rid, days_mask(days)))
+                        else:
+                            bad.append(rid)
+                    # исходную колонку без полного переноса не удаляем:
+                    # исключение откатывает всю транзакцию
+                    if bad:
+                        raise RuntimeError(
+                            f"day_of_week не разобран у напоминаний {bad} — "
+                            "исправьте значения и перезапустите бота"
+                        )
+                    await conn.executemany(
+                        "UPDATE reminders SET days=$2 WHERE id=$1", masks
+                    )
+                    await conn.execute(
+                        "ALTER TABLE reminders ALTER COLUMN days SET NOT NULL"
+                    )
+                    await conn.execute("ALTER TABLE reminders DROP COLUMN day_of_week")
+            except asyncpg.InsufficientPrivilegeError:
+                logger.error(
+                    "Нет прав на перевод day_of_week в days — "
+                    "выполните миграцию владельцем таблицы"
+                )
+                raise
+
+
+async def load_allowed_users():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM allowed_users")
+    allowed_users.clear()
+    allowed_users.update(r[0] for r in rows)
+
+def is_allowed(user_id: int) -> bool:
+    return user_id in ADMIN_IDS or user_id in allowed_users
+
+# Что требует доступа: команды, кнопки клавиатуры и inline-кнопки
+GUARDED = {
+    "/add", "/list", "/delete",
+    "Добавить", "Список", "Удалить",
+    "add", "list", "delete",
+}
 
-def load_jobs():
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        if HAS_THREAD_COL:
-            cur.execute("""
-              SELECT r.id,
-                     r.day_of_week,
-                     r.time,
-                     r.text,
-                     r.chat_id,
-                     r.message_thread_id,
-                     COALESCE(ut.timezone,'UTC')
-                FROM reminders r
-                LEFT JOIN user_timezones ut ON r.user_id=ut.user_id
-            """)
-            rows = cur.fetchall()
-        else:
-            # если нет колонки message_thread_id — не пытаемся её читать
-            cur.execute("""
-              SELECT r.id,
-                     r.day_of_week,
-                     r.time,
-                     r.text,
-                     r.chat_id,
-                     COALESCE(ut.timezone,'UTC')
-                FROM reminders r
-                LEFT JOIN user_timezones ut ON r.user_id=ut.user_id
-            """)
-            tmp = cur.fetchall()
-            # подставляем None вместо thread_id
-            rows = [
-                (rid, day, tm, txt, cid, None, tz)
-                for (rid, day, tm, txt, cid, tz) in tmp
-            ]
-        cur.close()
-    finally:
-        put_conn(conn)
-
-    for rid, db_days, tm, txt, cid, thr, tz in rows:
-        # db_days может быть "понедельник,среда,пятница"
-        parts = [d.strip() for d in db_days.split(",")]
-        cron_days = ",".join(RU_TO_CRON_DAY[d] for d in parts)
-
-        if hasattr(tm, "hour"):
-            hh, mm = tm.hour, tm.minute
+async def access_guard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # одна проверка до всех обработчиков (group=-1) вместо копий в каждом
+    user = update.effective_user
+    if not user or is_allowed(user.id):
+        return
+    msg = update.effective_message
+    if update.callback_query:
+        key = update.callback_query.data
+    elif msg and msg.text:
+        # effective_message — чтобы правка сообщения тоже проверялась
+        if msg.text.startswith("/"):
+            cmd, _, target = msg.text.split(maxsplit=1)[0].partition("@")
+            # /list@ДругойБот CommandHandler нам не отдаёт — и мы не трогаем
+            if target and target.lower() != (ctx.bot.username or "").lower():
+                return
+            # команды PTB сравнивает без учёта регистра
+            key = cmd.lower()
         else:
-            hh, mm = map(int, str(tm).split(":"))
-
-        scheduler.add_job(
-            send_reminder,
-            trigger="cron",
-            id=str(rid),
-            day_of_week=cron_days,
-            hour=hh, minute=mm,
-            timezone=tz,
-            args=[cid, thr, txt]
+            # кнопка — это всё сообщение целиком, как в filters.Text
+            key = msg.text
+    else:
+        return
+    if key not in GUARDED:
+        return
+    # ответ и уборка команды — независимые запросы к API, шлём параллельно
+    await asyncio.gather(
+        cleanup_trigger(update),
+        send_temp(
+            update.effective_chat.id, "Доступ запрещён.",
+            update.effective_message.message_thread_id,
+            reply_markup=MAIN_KB
         )
+    )
+    raise ApplicationHandlerStop
+
+def global_autodel_enabled() -> bool:
+    return autodel_global
+
+def set_autodel_global(enabled: bool):
+    global autodel_global
+    autodel_global = enabled
+
+AUTODEL_GLOBAL_Q = "SELECT value FROM config WHERE key='auto_delete_enabled'"
+
+async def load_autodel_global():
+    async with db_pool.acquire() as conn:
+        value = await conn.fetchval(AUTODEL_GLOBAL_Q)
+    set_autodel_global(value == 'true')
+
+def on_autodel_notify(conn, pid, channel, payload):
+    set_autodel_global(payload == "true")
+
+async def autodel_listener():
+    # отдельное соединение вне пула: ловим NOTIFY от других экземпляров бота
+    # (общий у них только флаг автоудаления — см. комментарий у кэшей)
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(
+                **{**DB_PARAMS, "host": DB_LISTEN_HOST, "port": DB_LISTEN_PORT}
+            )
+            await conn.add_listener(AUTODEL_CHANNEL, on_autodel_notify)
+            # после каждой (пере)подписки перечитываем флаг: NOTIFY, пришедшие
+            # пока соединения не было, потеряны
+            set_autodel_global(await conn.fetchval(AUTODEL_GLOBAL_Q) == 'true')
+            autodel_listening.set()
+            while True:
+                await asyncio.sleep(60)
+                # пинг заодно выявляет оборванное соединение
+                await conn.execute("SELECT 1")
+        except asyncio.CancelledError:
+            if conn is not None:
+                await conn.close()
+            raise
+        except Exception as e:
+            logger.warning("LISTEN %s оборвался: %s", AUTODEL_CHANNEL, e)
+            if conn is not None:
+                conn.terminate()
+            await asyncio.sleep(5)
+
+async def load_autodel_users():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM auto_delete_users")
+    autodel_users.user_ids = [r[0] for r in rows]
+
+async def send_reminder(ctx: ContextTypes.DEFAULT_TYPE):
+    # колбэк JobQueue: ошибки уходят в error handlers приложения
+    chat_id, thread_id, text = ctx.job.data
+    await send_temp(chat_id, text, thread_id)
+
+def schedule_reminder(job_queue, rid: int, trigger: CronTrigger,
+                      chat_id: int, thread_id: int|None, text: str):
+    # через JobQueue, а не scheduler.add_job: задача обёрнута в PTB Job
+    job_queue.run_custom(
+        send_reminder,
+        job_kwargs={"trigger": trigger, "id": str(rid), **REMINDER_JOB_OPTS},
+        data=(chat_id, thread_id, text)
+    )
 
+LOAD_BATCH = 500
+
+async def load_jobs(job_queue):
+    # если нет колонки message_thread_id — не пытаемся её читать
+    thr_col = "r.message_thread_id" if HAS_THREAD_COL else "NULL::bigint"
+    sql = f"""
+      SELECT r.id,
+             r.days,
+             r.time,
+             r.text,
+             r.chat_id,
+             {thr_col},
+             COALESCE(ut.timezone,'UTC')
+        FROM reminders r
+        LEFT JOIN user_timezones ut ON r.user_id=ut.user_id
+    """
+    # серверный курсор: строки приходят пачками, весь список в памяти не держим
+    async with db_pool.acquire() as conn, conn.transaction():
+        rows = conn.cursor(sql, prefetch=LOAD_BATCH)
+        async for rid, mask, tm, txt, cid, thr, tz in rows:
+            if not mask:
+                logger.warning("Напоминание %s без дней недели — пропускаем", rid)
+                continue
+            trigger = cron_trigger(mask_to_cron(mask), tm.hour, tm.minute, tz)
+            # планировщик ещё не запущен (его стартует Application.start()),
+            # так что задачи лишь копятся — пересчёт пробуждения один
+            schedule_reminder(job_queue, rid, trigger, cid, thr, txt)
+
+
+async def load_timezones():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id, timezone FROM user_timezones")
+    tz_cache.clear()
+    tz_cache.update((r[0], r[1]) for r in rows)
 
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    tzrec = None
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT timezone FROM user_timezones WHERE user_id=%s",
-            (update.effective_user.id,)
-        )
-        tzrec = cur.fetchone()
-        cur.close()
-    finally:
-        put_conn(conn)
+    thr = update.effective_message.message_thread_id
+    tzrec = tz_cache.get(update.effective_user.id)
 
     chat_id = update.effective_chat.id
+    cleanup = asyncio.create_task(cleanup_trigger(update))
     if not tzrec:
         kb = [[KeyboardButton("📍 Отправить местоположение", request_location=True)]]
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id":chat_id,
-            "text":"Привет! Отправьте геолокацию:",
-            "reply_markup":ReplyKeyboardMarkup(kb,resize_keyboard=True,one_time_keyboard=True)
-        }, update))
+        msg = await ctx.bot.send_message(
+            chat_id=chat_id,
+            text="Привет! Отправьте геолокацию:",
+            reply_markup=ReplyKeyboardMarkup(kb,resize_keyboard=True,one_time_keyboard=True),
+            message_thread_id=thr
+        )
     else:
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id":chat_id,
-            "text":"С возвращением! Выберите действие:",
-            "reply_markup":get_main_keyboard()
-        }, update))
-        await ctx.bot.send_message(**with_thread({
-            "chat_id":chat_id,
-            "text":"Или нажмите на кнопку:",
-            "reply_markup":INLINE_KB
-        }, update))
+        msg = await ctx.bot.send_message(
+            chat_id=chat_id,
+            text="С возвращением! Выберите действие:",
+            reply_markup=MAIN_KB,
+            message_thread_id=thr
+        )
+        await ctx.bot.send_message(
+            chat_id=chat_id,
+            text="Или нажмите на кнопку:",
+            reply_markup=INLINE_KB,
+            message_thread_id=thr
+        )
     record_bot_message(msg.chat_id, msg.message_id)
-    try:
-        await ctx.bot.delete_message(chat_id, update.message.message_id)
-    except:
-        pass
+    await cleanup
+
+async def db_set_tz(user_id: int, tz_str: str):
+    async with db_pool.acquire() as conn:
+        await conn.execute(SQL["upsert_tz"], user_id, tz_str)
 
 async def location_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    thr = update.effective_message.message_thread_id
     loc = update.message.location
     if not loc:
         return
-    tz_str = tf.timezone_at(lat=loc.latitude, lng=loc.longitude) or "UTC"
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-          INSERT INTO user_timezones(user_id,timezone)
-          VALUES(%s,%s)
-          ON CONFLICT(user_id) DO UPDATE SET timezone=EXCLUDED.timezone
-        """, (update.effective_user.id, tz_str))
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
+    # поиск по полигонам (и первая загрузка полного finder'а) — CPU и диск,
+    # event loop им не занимаем
+    tz_str = await asyncio.to_thread(timezone_at, loc.latitude, loc.longitude)
+    await db_set_tz(update.effective_user.id, tz_str)
+    tz_cache[update.effective_user.id] = tz_str
     chat_id = update.effective_chat.id
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":f"Часовой пояс: {tz_str}",
-        "reply_markup":get_main_keyboard()
-    }, update))
+    msg = await ctx.bot.send_message(
+        chat_id=chat_id,
+        text=f"Часовой пояс: {tz_str}",
+        reply_markup=MAIN_KB,
+        message_thread_id=thr
+    )
     record_bot_message(msg.chat_id, msg.message_id)
     schedule_deletion(chat_id, update.message.message_id)
 
 async def help_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.callback_query:
-        await update.callback_query.answer()
+    thr = update.effective_message.message_thread_id
     chat_id = update.effective_chat.id
-    try:
-        if update.message:
-            await ctx.bot.delete_message(chat_id, update.message.message_id)
-    except:
-        pass
     text = (
         "Команды:\n"
         "/add — добавить напоминание\n"
         "/list — список напоминаний\n"
         "/delete — удалить напоминание по ID\n\n"
     )
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":text,
-        "reply_markup":get_main_keyboard()
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
-
-async def list_reminders(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.callback_query:
-        await update.callback_query.answer()
-        chat_id = update.callback_query.message.chat_id
-        uid     = update.callback_query.from_user.id
-    else:
-        chat_id = update.effective_chat.id
-        uid     = update.effective_user.id
-        try: await ctx.bot.delete_message(chat_id, update.message.message_id)
-        except: pass
-
-    if not await is_allowed(uid):
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id": chat_id,
-            "text": "Доступ запрещён.",
-            "reply_markup": get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
-        return
-
-    # вытягиваем все записи
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-          SELECT id, day_of_week, time, text
-            FROM reminders
-           WHERE user_id=%s AND chat_id=%s
-           ORDER BY id
-        """, (uid, chat_id))
-        rows = cur.fetchall()
-        cur.close()
-    finally:
-        put_conn(conn)
+    await asyncio.gather(
+        cleanup_trigger(update),
+        send_temp(chat_id, text, thr, reply_markup=MAIN_KB)
+    )
 
-    if not rows:
-        chunks = ["Нет напоминаний."]
-    else:
-        # нумеруем от 1 до len(rows)
-        lines = [
-            f"{idx}: {day}, {tm}, {txt}"
-            for idx, ( _id, day, tm, txt ) in enumerate(rows, start=1)
-        ]
+LIST_MAX_LEN = 4000
+
+async def db_reminder_chunks(uid: int, chat_id: int) -> list[str]:
+    # строки форматируем прямо из курсора и режем на чанки по лимиту;
+    # соединение отпускаем до отправки в Telegram
+    chunks = []
+    buf = io.StringIO()
+    buf.write("Напоминания:\n")
+    n = 0
+    async with db_pool.acquire() as conn, conn.transaction():
+        rows = conn.cursor(SQL["select_reminders_user_chat"], uid, chat_id, prefetch=100)
+        async for mask, tm, txt in rows:
+            # нумеруем от 1, а не SERIAL-id
+            n += 1
+            line = f"{n}: {mask_to_ru(mask)}, {tm}, {txt}\n"
+            if buf.tell() + len(line) > LIST_MAX_LEN:
+                chunks.append(buf.getvalue())
+                buf = io.StringIO()
+            buf.write(line)
+    if not n:
+        return ["Нет напоминаний."]
+    chunks.append(buf.getvalue())
+    return chunks
 
-        # дробим на чанки по 4000 символов
-        chunks = []
-        cur_text = "Напоминания:\n"
-        MAX_LEN = 4000
-        for line in lines:
-            if len(cur_text) + len(line) + 1 > MAX_LEN:
-                chunks.append(cur_text)
-                cur_text = ""
-            cur_text += line + "\n"
-        if cur_text:
-            chunks.append(cur_text)
+async def list_reminders(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    thr = update.effective_message.message_thread_id
+    chat_id = update.effective_chat.id
+    uid     = update.effective_user.id
+    # уборка команды идёт параллельно с запросом в БД
+    _, chunks = await asyncio.gather(
+        cleanup_trigger(update),
+        db_reminder_chunks(uid, chat_id)
+    )
 
     # отправляем все чанки
     for chunk in chunks:
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id": chat_id,
-            "text": chunk,
-            "reply_markup": get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
+        await send_temp(chat_id, chunk, thr, reply_markup=MAIN_KB)
 
 
+async def db_add_user(user_id: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO allowed_users(user_id) VALUES($1) ON CONFLICT DO NOTHING",
+            user_id
+        )
+
+async def admin_reply(update: Update, text: str):
+    # как reply_text: в группах цитируем команду, в личке — нет
+    msg = update.effective_message
+    quote = msg.message_id if update.effective_chat.type != "private" else None
+    await send_temp(
+        msg.chat_id, text, msg.message_thread_id,
+        reply_to_message_id=quote, reply_markup=MAIN_KB
+    )
+
 async def add_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
     if not ctx.args or not ctx.args[0].isdigit():
-        msg = await update.message.reply_text(
-            "Использование: /adduser <user_id>",
-            reply_markup=get_main_keyboard()
-        )
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
+        await admin_reply(update, "Использование: /adduser <user_id>")
         return
     new_id = int(ctx.args[0])
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO allowed_users(user_id) VALUES(%s) ON CONFLICT DO NOTHING",
-            (new_id,)
-        )
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
-    msg = await update.message.reply_text(
-        f"Пользователь {new_id} добавлен.",
-        reply_markup=get_main_keyboard()
-    )
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    await db_add_user(new_id)
+    allowed_users.add(new_id)
+    await admin_reply(update, f"Пользователь {new_id} добавлен.")
+
+async def db_remove_user(user_id: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute("DELETE FROM allowed_users WHERE user_id=$1", user_id)
 
 async def remove_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
     if not ctx.args or not ctx.args[0].isdigit():
-        msg = await update.message.reply_text(
-            "Использование: /removeuser <user_id>",
-            reply_markup=get_main_keyboard()
-        )
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
+        await admin_reply(update, "Использование: /removeuser <user_id>")
         return
     rem_id = int(ctx.args[0])
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM allowed_users WHERE user_id=%s", (rem_id,))
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
-    msg = await update.message.reply_text(
-        f"Пользователь {rem_id} удалён.",
-        reply_markup=get_main_keyboard()
-    )
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    await db_remove_user(rem_id)
+    allowed_users.discard(rem_id)
+    await admin_reply(update, f"Пользователь {rem_id} удалён.")
+
+async def db_add_auto_del_user(user_id: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO auto_delete_users(user_id) VALUES($1) ON CONFLICT DO NOTHING",
+            user_id
+        )
 
 async def add_auto_del_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
@@ -538,19 +851,14 @@ async def add_auto_del_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Использование: /adddeluser <user_id>")
         return
     target = int(ctx.args[0])
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO auto_delete_users(user_id) VALUES(%s) ON CONFLICT DO NOTHING",
-            (target,)
-        )
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
+    await db_add_auto_del_user(target)
+    autodel_users.add_user_ids(target)
     await update.message.reply_text(f"Auto-delete: {target}")
 
+async def db_remove_auto_del_user(user_id: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute("DELETE FROM auto_delete_users WHERE user_id=$1", user_id)
+
 async def remove_auto_del_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
@@ -558,34 +866,35 @@ async def remove_auto_del_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Использование: /removedeluser <user_id>")
         return
     target = int(ctx.args[0])
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM auto_delete_users WHERE user_id=%s", (target,))
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
+    await db_remove_auto_del_user(target)
+    autodel_users.remove_user_ids(target)
     await update.message.reply_text(f"Removed auto-delete: {target}")
 
+async def db_list_auto_del_users() -> list:
+    async with db_pool.acquire() as conn:
+        return await conn.fetch("SELECT user_id FROM auto_delete_users ORDER BY user_id")
+
 async def list_auto_del_users(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM auto_delete_users ORDER BY user_id")
-        rows = cur.fetchall()
-        cur.close()
-    finally:
-        put_conn(conn)
+    rows = await db_list_auto_del_users()
     if not rows:
         text = "Список пуст."
     else:
         text = "Auto-delete users:\n" + "\n".join(str(r[0]) for r in rows)
     await update.message.reply_text(text)
 
+async def db_set_autodel_global(enabled: bool):
+    value = "true" if enabled else "false"
+    # UPDATE и NOTIFY — одной транзакцией
+    async with db_pool.acquire() as conn, conn.transaction():
+        await conn.execute(
+            "UPDATE config SET value=$1 WHERE key='auto_delete_enabled'", value
+        )
+        await conn.execute("SELECT pg_notify($1, $2)", AUTODEL_CHANNEL, value)
+
 async def enable_autodel_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    thr = update.effective_message.message_thread_id
     if update.effective_user.id not in ADMIN_IDS:
         return
     if update.callback_query:
@@ -593,24 +902,12 @@ async def enable_autodel_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = update.callback_query.message.chat_id
     else:
         chat_id = update.effective_chat.id
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE config SET value='true' WHERE key='auto_delete_enabled'"
-        )
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":"Функция ВКЛЮЧЕНА."
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    await db_set_autodel_global(True)
+    set_autodel_global(True)
+    await send_temp(chat_id, "Функция ВКЛЮЧЕНА.", thr)
 
 async def disable_autodel_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    thr = update.effective_message.message_thread_id
     if update.effective_user.id not in ADMIN_IDS:
         return
     if update.callback_query:
@@ -618,24 +915,12 @@ async def disable_autodel_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         chat_id = update.callback_query.message.chat_id
     else:
         chat_id = update.effective_chat.id
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE config SET value='false' WHERE key='auto_delete_enabled'"
-        )
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":"Функция ОТКЛЮЧЕНА."
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    await db_set_autodel_global(False)
+    set_autodel_global(False)
+    await send_temp(chat_id, "Функция ОТКЛЮЧЕНА.", thr)
 
 async def status_autodel_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    thr = update.effective_message.message_thread_id
     if update.effective_user.id not in ADMIN_IDS:
         return
     if update.callback_query:
@@ -644,336 +929,168 @@ async def status_autodel_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     else:
         chat_id = update.effective_chat.id
     enabled = global_autodel_enabled()
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":f"Функция {'ВКЛЮЧЕНА' if enabled else 'ОТКЛЮЧЕНА'}."
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    await send_temp(
+        chat_id, f"Функция {'ВКЛЮЧЕНА' if enabled else 'ОТКЛЮЧЕНА'}.", thr
+    )
 
 async def start_add(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.callback_query:
-        await update.callback_query.answer()
-        chat_id = update.callback_query.message.chat_id
-        uid     = update.callback_query.from_user.id
-    else:
-        chat_id = update.effective_chat.id
-        uid     = update.effective_user.id
-        try:
-            await ctx.bot.delete_message(chat_id, update.message.message_id)
-        except:
-            pass
-    if not await is_allowed(uid):
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id":chat_id,
-            "text":"Доступ запрещён.",
-            "reply_markup":get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
-        return ConversationHandler.END
-    ctx.user_data["thread_id"] = get_thread_id(update)
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":"Введите: <день> <HH:MM> <текст>"
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    thr = update.effective_message.message_thread_id
+    ctx.user_data["thread_id"] = thr
+    await asyncio.gather(
+        cleanup_trigger(update),
+        send_temp(update.effective_chat.id, "Введите: <день> <HH:MM> <текст>", thr)
+    )
     return ADD_INPUT
 
+async def db_add_reminder(sql: str, params: tuple) -> tuple:
+    # --- один запрос: SERIAL-id и порядковый номер в списке ---
+    async with db_pool.acquire() as conn:
+        rid, pos = await conn.fetchrow(sql, *params)
+    return rid, pos
+
 async def add_input(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    thr = update.effective_message.message_thread_id
     text = update.message.text or ""
-    if text in ("Список","Помощь"):
-        if text == "Список":
-            await list_reminders(update, ctx)
-        else:
-            await help_cmd(update, ctx)
+    button = BUTTON_HANDLERS.get(text)
+    if button:
+        await button(update, ctx)
         return ConversationHandler.END
 
     parts = text.split(" ", 2)
     if len(parts) < 3:
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id":update.effective_chat.id,
-            "text":"Неверный формат, /cancel.",
-            "reply_markup":get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
+        await send_temp(
+            update.effective_chat.id, "Неверный формат, /cancel.", thr,
+            reply_markup=MAIN_KB
+        )
         return ADD_INPUT
 
     day_raw, time_str, rem_text = parts
-    dr = day_raw.lower().replace(";",",").replace("/",",")\
-                       .replace("–","-").replace("—","-")
-    ru_days = []
-
-    if "-" in dr and "," not in dr:
-        a, b = [x.strip() for x in dr.split("-", 1)]
-        if a.isdigit(): a = NUM_TO_RU_DAY.get(a)
-        if b.isdigit(): b = NUM_TO_RU_DAY.get(b)
-        if a not in WEEK or b not in WEEK:
-            msg = await ctx.bot.send_message(**with_thread({
-                "chat_id":update.effective_chat.id,
-                "text":"Неверный день.",
-                "reply_markup":get_main_keyboard()
-            }, update))
-            record_bot_message(msg.chat_id, msg.message_id)
-            schedule_deletion(msg.chat_id, msg.message_id)
-            return ADD_INPUT
-        i0, i1 = WEEK.index(a), WEEK.index(b)
-        if i0 <= i1:
-            idx = range(i0, i1+1)
-        else:
-            idx = list(range(i0, 7)) + list(range(0, i1+1))
-        ru_days = [WEEK[i] for i in idx]
-
-    elif "," in dr:
-        for tok in dr.split(","):
-            d = tok.strip()
-            if d.isdigit():
-                d = NUM_TO_RU_DAY.get(d)
-            if d not in RU_TO_CRON_DAY:
-                msg = await ctx.bot.send_message(**with_thread({
-                    "chat_id":update.effective_chat.id,
-                    "text":"Неверный день.",
-                    "reply_markup":get_main_keyboard()
-                }, update))
-                record_bot_message(msg.chat_id, msg.message_id)
-                schedule_deletion(msg.chat_id, msg.message_id)
-                return ADD_INPUT
-            ru_days.append(d)
-
-    else:
-        d = dr.strip()
-        if d.isdigit():
-            d = NUM_TO_RU_DAY.get(d)
-        if d not in RU_TO_CRON_DAY:
-            msg = await ctx.bot.send_message(**with_thread({
-                "chat_id":update.effective_chat.id,
-                "text":"Неверный день.",
-                "reply_markup":get_main_keyboard()
-            }, update))
-            record_bot_message(msg.chat_id, msg.message_id)
-            schedule_deletion(msg.chat_id, msg.message_id)
-            return ADD_INPUT
-        ru_days = [d]
+    dr = day_raw.lower().translate(DAY_SEP_TABLE)
+    days = parse_days(dr)
+    if not days:
+        await send_temp(
+            update.effective_chat.id, "Неверный день.", thr,
+            reply_markup=MAIN_KB
+        )
+        return ADD_INPUT
 
-    try:
-        hh, mm = map(int, time_str.split(":"))
-        assert 0 <= hh < 24 and 0 <= mm < 60
-    except:
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id":update.effective_chat.id,
-            "text":"Неверное время.",
-            "reply_markup":get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
+    m = TIME_RE.fullmatch(time_str)
+    if not m:
+        await send_temp(
+            update.effective_chat.id, "Неверное время.", thr,
+            reply_markup=MAIN_KB
+        )
         return ADD_INPUT
+    hh, mm = int(m.group(1)), int(m.group(2))
 
-    db_days   = ",".join(ru_days)
-    cron_days = ",".join(RU_TO_CRON_DAY[d] for d in ru_days)
+    mask      = days_mask(days)
+    cron_days = mask_to_cron(mask)
 
     uid     = update.effective_user.id
     chat_id = update.effective_chat.id
-    thr     = ctx.user_data.get("thread_id")
+    rem_thr = ctx.user_data.get("thread_id")
 
+    # asyncpg кодирует TIME только из datetime.time
+    tm = datetime.time(hh, mm)
     if HAS_THREAD_COL:
-        sql = """INSERT INTO reminders
-                 (user_id,chat_id,message_thread_id,day_of_week,time,text)
-                 VALUES(%s,%s,%s,%s,%s,%s) RETURNING id"""
-        params = (uid, chat_id, thr, db_days, time_str, rem_text)
+        sql = SQL["insert_reminder_thr"]
+        params = (uid, chat_id, rem_thr, mask, tm, rem_text)
     else:
-        sql = """INSERT INTO reminders
-                 (user_id,chat_id,day_of_week,time,text)
-                 VALUES(%s,%s,%s,%s,%s) RETURNING id"""
-        params = (uid, chat_id, db_days, time_str, rem_text)
+        sql = SQL["insert_reminder"]
+        params = (uid, chat_id, mask, tm, rem_text)
 
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(sql, params)
-        rid = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
-
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT timezone FROM user_timezones WHERE user_id=%s",
-            (uid,)
-        )
-        row = cur.fetchone()
-        cur.close()
-    finally:
-        put_conn(conn)
-    tz = row[0] if row else "UTC"
-
-    scheduler.add_job(
-        send_reminder, trigger="cron", id=str(rid),
-        day_of_week=cron_days, hour=hh, minute=mm,
-        timezone=tz, args=[chat_id, thr, rem_text]
+    rid, pos = await db_add_reminder(sql, params)
+    tz = tz_cache.get(uid, "UTC")
+
+    schedule_reminder(
+        ctx.job_queue, rid, cron_trigger(cron_days, hh, mm, tz),
+        chat_id, rem_thr, rem_text
     )
 
-    # --- вычисляем порядковый номер в списке, а не SERIAL-id ---
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id FROM reminders WHERE user_id=%s AND chat_id=%s ORDER BY id",
-            (uid, chat_id)
-        )
-        all_ids = [row[0] for row in cur.fetchall()]
-        cur.close()
-    finally:
-        put_conn(conn)
-    pos = all_ids.index(rid) + 1
-
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":f"Добавлено #{pos}",
-        "reply_markup":get_main_keyboard()
-    },update))
-    record_bot_message(msg.chat_id,msg.message_id)
-    schedule_deletion(msg.chat_id,msg.message_id)
+    await send_temp(
+        chat_id, f"Добавлено #{pos}", thr,
+        reply_markup=MAIN_KB
+    )
     return ConversationHandler.END
 
 async def start_delete(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.callback_query:
-        await update.callback_query.answer()
-        chat_id = update.callback_query.message.chat_id
-        uid     = update.callback_query.from_user.id
-    else:
-        chat_id = update.effective_chat.id
-        uid     = update.effective_user.id
-        try:
-            await ctx.bot.delete_message(chat_id, update.message.message_id)
-        except:
-            pass
-    if not await is_allowed(uid):
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id":chat_id,
-            "text":"Доступ запрещён.",
-            "reply_markup":get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
-        return ConversationHandler.END
-    ctx.user_data["thread_id"] = get_thread_id(update)
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":chat_id,
-        "text":"Введите ID для удаления:"
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    thr = update.effective_message.message_thread_id
+    ctx.user_data["thread_id"] = thr
+    await asyncio.gather(
+        cleanup_trigger(update),
+        send_temp(update.effective_chat.id, "Введите ID для удаления:", thr)
+    )
     return DELETE_INPUT
 
+async def db_delete_reminder_at(uid: int, chat_id: int, pos: int) -> int|None:
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval(SQL["delete_reminder_at"], uid, chat_id, pos - 1)
+
 async def delete_input(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    thr = update.effective_message.message_thread_id
     txt = update.message.text or ""
     
     if not txt.isdigit():
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id": update.effective_chat.id,
-            "text": "ID должен быть числом (позиция в списке).",
-            "reply_markup": get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
+        await send_temp(
+            update.effective_chat.id, "ID должен быть числом (позиция в списке).", thr,
+            reply_markup=MAIN_KB
+        )
         return DELETE_INPUT
 
     pos = int(txt)    
     uid = update.effective_user.id
     chat_id = update.effective_chat.id
 
-    
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-          SELECT id
-            FROM reminders
-           WHERE user_id=%s AND chat_id=%s
-           ORDER BY id
-        """, (uid, chat_id))
-        id_list = [r[0] for r in cur.fetchall()]
-        cur.close()
-    finally:
-        put_conn(conn)
-
-    
-    if pos < 1 or pos > len(id_list):
-        msg = await ctx.bot.send_message(**with_thread({
-            "chat_id": chat_id,
-            "text": "Не найдено напоминание с таким номером.",
-            "reply_markup": get_main_keyboard()
-        }, update))
-        record_bot_message(msg.chat_id, msg.message_id)
-        schedule_deletion(msg.chat_id, msg.message_id)
+    # слишком большой номер не влезет в bigint параметра OFFSET
+    real_id = await db_delete_reminder_at(uid, chat_id, pos) if 0 < pos < 2**62 else None
+    if real_id is None:
+        await send_temp(
+            chat_id, "Не найдено напоминание с таким номером.", thr,
+            reply_markup=MAIN_KB
+        )
         return ConversationHandler.END
 
-    real_id = id_list[pos-1]
+    try: ctx.job_queue.scheduler.remove_job(str(real_id))
+    except JobLookupError: pass
 
-    
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM reminders WHERE id=%s", (real_id,))
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
-    try: scheduler.remove_job(str(real_id))
-    except: pass
-
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id": chat_id,
-        "text": f"Удалено напоминание #{pos}",
-        "reply_markup": get_main_keyboard()
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    await send_temp(
+        chat_id, f"Удалено напоминание #{pos}", thr,
+        reply_markup=MAIN_KB
+    )
     return ConversationHandler.END
 
 
 async def cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.message:
-        try:
-            await ctx.bot.delete_message(update.effective_chat.id, update.message.message_id)
-        except:
-            pass
-    msg = await ctx.bot.send_message(**with_thread({
-        "chat_id":update.effective_chat.id,
-        "text":"Отменено.",
-        "reply_markup":get_main_keyboard()
-    }, update))
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    thr = update.effective_message.message_thread_id
+    await asyncio.gather(
+        cleanup_trigger(update),
+        send_temp(
+            update.effective_chat.id, "Отменено.", thr,
+            reply_markup=MAIN_KB
+        )
+    )
     return ConversationHandler.END
 
+async def db_pop_bot_messages(chat_id: int) -> list[int]:
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "DELETE FROM bot_messages WHERE chat_id=$1 RETURNING message_id",
+            chat_id
+        )
+    return [r[0] for r in rows]
+
 async def clear_chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
     chat_id = update.effective_chat.id
-    conn = get_conn()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT message_id FROM bot_messages WHERE chat_id=%s", (chat_id,))
-        mids = [r[0] for r in cur.fetchall()]
-        for mid in mids:
-            try:
-                await ctx.bot.delete_message(chat_id=chat_id, message_id=mid)
-            except:
-                pass
-        cur.execute("DELETE FROM bot_messages WHERE chat_id=%s", (chat_id,))
-        conn.commit()
-        cur.close()
-    finally:
-        put_conn(conn)
-    msg = await ctx.bot.send_message(chat_id=chat_id, text="Все сообщения удалены.")
-    record_bot_message(msg.chat_id, msg.message_id)
-    schedule_deletion(msg.chat_id, msg.message_id)
+    # соединение не держим, пока идут запросы к Telegram
+    await flush_bot_messages()
+    mids = await db_pop_bot_messages(chat_id)
+    # пачками по 100 через deleteMessages — даже тысячи сообщений
+    # укладываются в десяток запросов, лимит Telegram не задеваем
+    for i in range(0, len(mids), DELETE_BATCH):
+        await delete_msgs(chat_id, mids[i:i + DELETE_BATCH])
+    await send_temp(chat_id, "Все сообщения удалены.")
 
 async def delete_user_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
@@ -983,40 +1100,82 @@ async def delete_user_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     if msg.from_user.id == ctx.bot.id:
         return
-    conn = get_conn()
     try:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT 1 FROM auto_delete_users WHERE user_id=%s",
-            (msg.from_user.id,)
-        )
-        to_del = cur.fetchone() is not None
-        cur.close()
-    finally:
-        put_conn(conn)
-    if to_del:
-        try:
-            await ctx.bot.delete_message(chat_id=msg.chat_id, message_id=msg.message_id)
-        except:
-            pass
+        await ctx.bot.delete_message(chat_id=msg.chat_id, message_id=msg.message_id)
+    except TelegramError:
+        pass
+
+# Кнопки клавиатуры вне диалогов: один фильтр по точному тексту + словарь
+BUTTON_HANDLERS = {
+    "Список": list_reminders,
+    "Помощь": help_cmd,
+}
+
+async def button_dispatch(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    await BUTTON_HANDLERS[update.message.text](update, ctx)
+
+# Бесконечные фоновые задачи; post_init идёт до запуска Application, поэтому
+# создаём их сами и сами же отменяем в on_shutdown
+background_tasks: list[asyncio.Task] = []
+
+async def start_autodel_sync():
+    # слушатель сам читает флаг после подписки; не успел — читаем через пул
+    background_tasks.append(asyncio.create_task(autodel_listener()))
+    try:
+        await asyncio.wait_for(autodel_listening.wait(), 5)
+    except asyncio.TimeoutError:
+        await load_autodel_global()
 
 async def on_startup(app):
-    init_db()
-    if scheduler.state == STATE_STOPPED:
-        scheduler.start()
-        logger.info("Scheduler started")
-    load_jobs()
+    await create_db_pool()
+    # схема — до любых чтений, дальше независимые загрузки идут параллельно
+    await init_db()
+    await asyncio.gather(
+        load_allowed_users(),
+        load_autodel_users(),
+        load_timezones(),
+        start_autodel_sync(),
+        # JobQueue запустит планировщик сам в Application.start()
+        load_jobs(app.job_queue),
+    )
+    background_tasks.append(asyncio.create_task(bot_messages_flusher()))
+    background_tasks.append(asyncio.create_task(deletion_sweeper()))
+
+async def on_stop(app):
+    # post_stop: HTTP-клиент бота ещё жив — запущенные удаления успеют дойти.
+    # Сначала свипер и остальные циклы, потом порождённые им удаления
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await asyncio.gather(*delete_tasks, return_exceptions=True)
+
+async def on_shutdown(app):
+    # вызывается и после упавшего post_init — пула может не быть
+    if db_pool:
+        await flush_bot_messages()
+        await db_pool.close()
 
 if __name__ == "__main__":
+    if uvloop:
+        uvloop.install()
+    # напоминания одной минуты уходят пачкой — HTTP/2 мультиплексирует
+    # их по одному TLS-соединению, пул с запасом под всплески
+    bot_request = HTTPXRequest(
+        connection_pool_size=64, http_version="2",
+        connect_timeout=5, read_timeout=10
+    )
     application = ApplicationBuilder()\
         .token(BOT_TOKEN)\
+        .request(bot_request)\
         .post_init(on_startup)\
+        .post_stop(on_stop)\
+        .post_shutdown(on_shutdown)\
         .build()
 
     add_conv = ConversationHandler(
         entry_points=[
             CommandHandler("add", start_add),
-            MessageHandler(filters.Regex(r"^Добавить$"), start_add),
+            MessageHandler(filters.Text(["Добавить"]), start_add),
             CallbackQueryHandler(start_add, pattern="^add$")
         ],
         states={
@@ -1032,7 +1191,7 @@ if __name__ == "__main__":
     del_conv = ConversationHandler(
         entry_points=[
             CommandHandler("delete", start_delete),
-            MessageHandler(filters.Regex(r"^Удалить$"), start_delete),
+            MessageHandler(filters.Text(["Удалить"]), start_delete),
             CallbackQueryHandler(start_delete, pattern="^delete$")
         ],
         states={
@@ -1046,13 +1205,13 @@ if __name__ == "__main__":
         per_chat=True, per_user=True, allow_reentry=True
     )
 
+    application.add_handler(TypeHandler(Update, access_guard), group=-1)
     application.add_handler(add_conv)
     application.add_handler(del_conv)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.LOCATION, location_handler))
     application.add_handler(CommandHandler("help", help_cmd))
-    application.add_handler(MessageHandler(filters.Regex(r"^Список$"), list_reminders))
-    application.add_handler(MessageHandler(filters.Regex(r"^Помощь$"), help_cmd))
+    application.add_handler(MessageHandler(filters.Text(list(BUTTON_HANDLERS)), button_dispatch))
     application.add_handler(CallbackQueryHandler(list_reminders, pattern="^list$"))
     application.add_handler(CallbackQueryHandler(help_cmd, pattern="^help$"))
     application.add_handler(CommandHandler("list", list_reminders))
@@ -1065,6 +1224,13 @@ if __name__ == "__main__":
     application.add_handler(CommandHandler("disableautodel", disable_autodel_all))
     application.add_handler(CommandHandler("autodelstatus", status_autodel_all))
     application.add_handler(CommandHandler("clearchat", clear_chat))
-    application.add_handler(MessageHandler(filters.ALL, delete_user_message), group=99)
+    application.add_handler(MessageHandler(autodel_users, delete_user_message), group=99)
 
-    application.run_polling()
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling(poll_interval=0, timeout=30)